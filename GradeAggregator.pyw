@@ -9,9 +9,7 @@ For details, please refer to the README.txt file
 
 import GradeUtils
 from GradeUtils import println
-from TskAggregator import TskAggregator
-from StemCspAggregator import StemCspAggregator
-from StemCsaAggregator import StemCsaAggregator
+import GradeService
 from sys import argv, exit
 from os import getcwd, path, chdir
 from tkinter import scrolledtext
@@ -22,15 +20,6 @@ import math
 
 useGui = True   # Use GUI or old command-line interface?
 
-# Double clicking the file or launching from another directory won't work unless we first "cd" to the app directory
-if len(argv) >= 1:
-    file = argv[0]
-    cwd = getcwd()
-    dir = path.dirname(file)
-    if not path.isabs(dir):
-        dir = cwd + "\\" + dir
-    chdir(dir)
-
 # A widget for read-only text output
 class TextOutput(scrolledtext.ScrolledText):
     def __init__ (self, win):
@@ -83,8 +72,72 @@ def assignment_due_dates_callback (due_dates : dict) -> bool:
 
     return True
 
+# Pop-up modal dialog to confirm roster matches for student names that aren't an exact match in Roster.csv
+alias_choices = {}
+alias_pop = None
+def alias_callback (ambiguous : dict) -> dict:
+    global alias_choices, alias_pop
+    alias_choices = {}
+    alias_pop = tk.Toplevel()
+    frame = tk.Frame(alias_pop)
+    tk.Label(frame, text="These students were not found in Roster.csv").grid(row=0, columnspan = 2)
+    tk.Label(frame, text="Pick the matching roster student, or leave blank to skip them").grid(row=1, columnspan = 2)
+    grid_row = 2
+    options = {}
+    for name, candidates in ambiguous.items():
+        options[name] = {}
+        for candidate in candidates:
+            options[name][candidate.last_name + ", " + candidate.first_name + " (P" + str(candidate.period) + ")"] = candidate
+        alias_choices[name] = tk.StringVar(frame, "")
+        tk.Label(frame, text=name).grid(row=grid_row, column = 0)
+        tk.OptionMenu(frame, alias_choices[name], "", *options[name].keys()).grid(row=grid_row, column = 1, sticky = "ew")
+        grid_row += 1
+    frame.pack(padx=10, pady=10)
+
+    alias_pop.protocol("WM_DELETE_WINDOW", alias_pop.destroy)
+    alias_pop.wait_window(frame)
+
+    confirmed = {}
+    for name, choice in alias_choices.items():
+        if choice.get() in options[name]:
+            confirmed[name] = options[name][choice.get()]
+    return confirmed
+
+# Aggregator wrapper, when GradeService.py is running - it does the work, and we just show the results
+def aggregate_with_service (key):
+    response = GradeService.submit_aggregate (key, None)
+    for msg in response["messages"]:
+        println (msg)
+    if "error" in response:
+        println ("Error: " + response["error"])
+        return
+    agg_file = response["agg_file"]
+
+    # Launch excel on the output file, so teacher can have a look
+    println ("Launching aggregation file \"" + agg_file + "\".")
+    GradeUtils.launch_excel (agg_file)
+
+    # If configured, also transform the aggregation in a manner suitable for Synergy bulk import, and show those files as well
+    if GradeUtils.synergy_import_configured():
+        response = GradeService.submit_synergy (agg_file, assignment_due_dates_callback, alias_callback)
+        for msg in response["messages"]:
+            println (msg)
+        if "error" in response:
+            println (response["error"])
+        else:
+            for file in response["files"]:
+                println ("Launching synergy bulk import file \"" + file + "\".")
+                GradeUtils.launch_excel (file)
+    else:
+        println ("Synergy bulk import aggregation not configured")
+
 # Aggregator wrapper
-def aggregate (aggregator):
+def aggregate (key):
+    if GradeService.service_running():
+        println ("\nRunning via GradeService")
+        aggregate_with_service (key)
+        return
+    aggregator = GradeService.get_aggregator (key)
     println ("\nRunning " + aggregator.name())
     aggregate_already_running = True
     input_file = aggregator.get_default_input_file()
@@ -103,7 +156,7 @@ def aggregate (aggregator):
     # If configured, also transform the aggregation in a manner suitable for Synergy bulk import, and show those files as well
     if GradeUtils.synergy_import_configured():
         output_dir = GradeUtils.get_synergy_output_dir(agg_file)
-        files = GradeUtils.agg_to_synergy (agg_file, output_dir, assignment_due_dates_callback)
+        files = GradeUtils.agg_to_synergy (agg_file, output_dir, assignment_due_dates_callback, alias_callback)
         if files is None or len(files) == 0:
             println ("Failed to create synergy bulk import file from aggregation file")
         else:
@@ -115,87 +168,99 @@ def aggregate (aggregator):
 
 # run_aggregator - run one of the aggregators asynchronously so the UI remains responsive
 # wrap each run in a try-catch block so we can output any error messages
-def async_wrapper (aggregator):
+def async_wrapper (key):
     try:
-        aggregate (aggregator)
+        aggregate (key)
     except Exception:
         tb = traceback.format_exc()
         println (tb)
-def run_aggregator (aggregator):
-    threading.Thread(target = async_wrapper, args = [aggregator]).start()
+def run_aggregator (key):
+    threading.Thread(target = async_wrapper, args = [key]).start()
 
 # Button actions for the three aggregators + help
 def help_btn_onclick():
     println ("\nSee https://github.com/marcshepard/GradeAggregator/blob/master/README.txt")
 
 def python_btn_onclick():
-    run_aggregator(TskAggregator())
+    run_aggregator("tsk")
 
 def principles_btn_onclick():
-    run_aggregator(StemCspAggregator())
+    run_aggregator("csp")
 
 def csa_btn_onclick():
-    run_aggregator(StemCsaAggregator())
-
-# GUI wrapper
-if useGui:
-    # Create the window
-    window = tk.Tk()
-    window.title("Grade aggregator")
-    frame = tk.Frame(window, relief = tk.RAISED)
-
-    # First row is a text lable telling folks what to do
-    tk.Label(frame, text="Click on the class you wish to aggregate").grid(row=0, column = 0, columnspan=4, sticky="ew")
-
-    # Second row are buttons for aggregator + a help button
-    tk.Button(frame, text="Python",     command=python_btn_onclick)    .grid(row=1, column=0, pady = 10)
-    tk.Button(frame, text="Principles", command=principles_btn_onclick).grid(row=1, column=1, pady = 10)
-    tk.Button(frame, text="Comp Sci A", command=csa_btn_onclick)       .grid(row=1, column=2, pady = 10)
-    tk.Button(frame, text="Help",       command=help_btn_onclick)      .grid(row=1, column=3, pady = 10)
-
-    # Last rows are for text output
-    text_widget = TextOutput (frame)
-    text_widget.grid(row=2, columnspan = 4)
-    frame.pack(padx=10, pady=10)
-    GradeUtils.print_func = text_widget.writeln
+    run_aggregator("csa")
 
-    window.mainloop()
-    exit (0)
+# Only run the app when this script is launched directly. GradeUtils writes Synergy files in worker processes, and on
+# Windows each worker imports this script too (as "__mp_main__"), so they must not open the GUI or run the aggregators
+if __name__ == "__main__":
+    # Double clicking the file or launching from another directory won't work unless we first "cd" to the app directory
+    if len(argv) >= 1:
+        file = argv[0]
+        cwd = getcwd()
+        dir = path.dirname(file)
+        if not path.isabs(dir):
+            dir = cwd + "\\" + dir
+        chdir(dir)
 
-# These aggregators do the heavy lifting, in a couse specific manner (since the exported spreadsheets are all quite different)
-aggregators = [TskAggregator(), StemCspAggregator(), StemCsaAggregator()]
+    # GUI wrapper
+    if useGui:
+        # Create the window
+        window = tk.Tk()
+        window.title("Grade aggregator")
+        frame = tk.Frame(window, relief = tk.RAISED)
 
-for aggregator in aggregators:
-    # Let each aggregator do it's thing
-    print()
-    input_file = aggregator.get_default_input_file()
-    aggregator_name = aggregator.name()
-    if input_file is None:
-        print (aggregator_name + ": Can't find an export file in the default location")
-        print ("Skipping aggregation for " + aggregator_name)
-        continue
-    print (aggregator_name + ": Processing " + input_file)
+        # First row is a text lable telling folks what to do
+        tk.Label(frame, text="Click on the class you wish to aggregate").grid(row=0, column = 0, columnspan=4, sticky="ew")
 
-    agg_file = GradeUtils.get_output_file_name(input_file, "Aggregated ")
-    if GradeUtils.is_current (agg_file, input_file):
-        print ("Aggregate file is already current: " + agg_file)
-        choice = input ("Do you want to reaggregate (r), launch excel (l), or skip (anything else)? ")
-        if choice == "r":
-            aggregator.aggregate(input_file, agg_file)
-        elif choice != "l":
+        # Second row are buttons for aggregator + a help button
+        tk.Button(frame, text="Python",     command=python_btn_onclick)    .grid(row=1, column=0, pady = 10)
+        tk.Button(frame, text="Principles", command=principles_btn_onclick).grid(row=1, column=1, pady = 10)
+        tk.Button(frame, text="Comp Sci A", command=csa_btn_onclick)       .grid(row=1, column=2, pady = 10)
+        tk.Button(frame, text="Help",       command=help_btn_onclick)      .grid(row=1, column=3, pady = 10)
+
+        # Last rows are for text output
+        text_widget = TextOutput (frame)
+        text_widget.grid(row=2, columnspan = 4)
+        frame.pack(padx=10, pady=10)
+        GradeUtils.print_func = text_widget.writeln
+
+        window.mainloop()
+        exit (0)
+
+    # These aggregators do the heavy lifting, in a couse specific manner (since the exported spreadsheets are all quite different)
+    aggregators = [GradeService.get_aggregator(key) for key in ["tsk", "csp", "csa"]]
+
+    for aggregator in aggregators:
+        # Let each aggregator do it's thing
+        print()
+        input_file = aggregator.get_default_input_file()
+        aggregator_name = aggregator.name()
+        if input_file is None:
+            print (aggregator_name + ": Can't find an export file in the default location")
+            print ("Skipping aggregation for " + aggregator_name)
             continue
-    else:
-        aggregator.aggregate(input_file, agg_file)
-    
-    # Launch excel on the output file, so teacher can have a look
-    GradeUtils.launch_excel (agg_file)
+        print (aggregator_name + ": Processing " + input_file)
 
-    # If configured, also transform the aggregation in a manner suitable for Synergy bulk import, and show those files as well
-    if GradeUtils.synergy_import_configured():
-        output_dir = GradeUtils.get_synergy_output_dir(agg_file)
-        files = GradeUtils.agg_to_synergy (agg_file, output_dir, None)
-        if files is None or len(files) == 0:
-            print ("Failed to create synergy import file")
+        agg_file = GradeUtils.get_output_file_name(input_file, "Aggregated ")
+        if GradeUtils.is_current (agg_file, input_file):
+            print ("Aggregate file is already current: " + agg_file)
+            choice = input ("Do you want to reaggregate (r), launch excel (l), or skip (anything else)? ")
+            if choice == "r":
+                aggregator.aggregate(input_file, agg_file)
+            elif choice != "l":
+                continue
         else:
-            for file in files:
-                GradeUtils.launch_excel (file)
+            aggregator.aggregate(input_file, agg_file)
+
+        # Launch excel on the output file, so teacher can have a look
+        GradeUtils.launch_excel (agg_file)
+
+        # If configured, also transform the aggregation in a manner suitable for Synergy bulk import, and show those files as well
+        if GradeUtils.synergy_import_configured():
+            output_dir = GradeUtils.get_synergy_output_dir(agg_file)
+            files = GradeUtils.agg_to_synergy (agg_file, output_dir, None)
+            if files is None or len(files) == 0:
+                print ("Failed to create synergy import file")
+            else:
+                for file in files:
+                    GradeUtils.launch_excel (file)
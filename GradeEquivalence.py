@@ -0,0 +1,402 @@
+"""
+GradeEquivalence.py - check that faster versions of the aggregators produce exactly the same grades as the reference versions
+
+Any vectorized, cached or otherwise faster replacement for TskAggregator.aggregate, the STEM aggregators, or
+GradeUtils.agg_to_synergy must produce the same output, cell for cell, as the frozen reference copies in GradeReference.py.
+This script generates random exports that look like the real ones (including the awkward parts: odd status strings,
+"a/b" cells, sparsely filled columns, column headers we don't recognize, and student names that don't match the roster),
+runs both versions on each, and reports any cells that differ along with how much faster the new version is.
+If the reference version fails on an input, the new version must fail in the same way; those trials are reported as
+INCONCLUSIVE, since no grades were compared, and the run fails if too few trials of any check got as far as comparing grades.
+
+Usage:
+    python GradeEquivalence.py [trials] [seed]
+
+By default the current TskAggregator, StemCspAggregator, StemCsaAggregator and GradeUtils.agg_to_synergy are checked.
+To check a new version before switching to it, call check_aggregator or check_synergy with it, e.g.:
+    GradeEquivalence.check_aggregator ("tsk", my_fast_aggregate, trials=50)
+"""
+
+import sys
+import os
+import csv
+import random
+import shutil
+import tempfile
+import time
+import traceback
+import pandas as pd
+from openpyxl import load_workbook
+import GradeUtils
+import GradeReference
+import TskAggregator
+import StemCspAggregator
+import StemCsaAggregator
+
+# Reference and (by default) current version of each aggregator
+reference_aggregators = {
+    "tsk": GradeReference.tsk_aggregate,
+    "csp": GradeReference.csp_aggregate,
+    "csa": GradeReference.csa_aggregate,
+}
+current_aggregators = {
+    "tsk": TskAggregator.aggregate,
+    "csp": StemCspAggregator.aggregate,
+    "csa": StemCsaAggregator.aggregate,
+}
+
+max_mismatches_shown = 10   # Number of differing cells to print for each failed comparison
+min_compared_fraction = 0.75    # Fraction of each check's trials that must get as far as comparing output for the run to pass
+unknown_header_fraction = 0.1   # Fraction of STEM exports that include column headers the aggregator doesn't recognize
+skipped_assignment_fraction = 0.25  # Fraction of assignments given an X, S or empty due date, so agg_to_synergy skips them
+
+# Results of one comparison between the reference and new versions
+class comparison:
+    def __init__(self, description):
+        self.description = description
+        self.mismatches = []    # Descriptions of each difference found
+        self.error = None       # Why no output was compared (e.g., the error both versions raised), if it wasn't
+        self.reference_time = 0.0
+        self.candidate_time = 0.0
+
+    def passed(self):
+        return len(self.mismatches) == 0
+
+    # True if the output of the two versions was actually compared (rather than, say, both versions raising the same error)
+    def compared(self):
+        return self.error is None
+
+    def status(self):
+        if not self.passed():
+            return "FAIL"
+        if not self.compared():
+            return "INCONCLUSIVE"
+        return "PASS"
+
+    def speedup(self):
+        if self.candidate_time == 0:
+            return float("inf")
+        return self.reference_time / self.candidate_time
+
+    def __str__(self):
+        s = self.status() + "\t" + self.description
+        s += "\t(reference {:.3f}s, new {:.3f}s, speedup {:.2f}x)".format(self.reference_time, self.candidate_time, self.speedup())
+        if self.error is not None:
+            s += "\n\t" + self.error
+        for mismatch in self.mismatches[:max_mismatches_shown]:
+            s += "\n\t" + mismatch
+        if len(self.mismatches) > max_mismatches_shown:
+            s += "\n\t... and " + str(len(self.mismatches) - max_mismatches_shown) + " more"
+        return s
+
+# Random student names; a few are very similar, to exercise name matching
+first_names = ["Ava", "Ben", "Carlos", "Dana", "Eli", "Fatima", "Grace", "Hiro", "Isla", "Jon", "Jonah", "Kai", "Lena", "Mateo", "Nora", "Omar"]
+last_names = ["Anderson", "Brown", "Chen", "Diaz", "Evans", "Garcia", "Ito", "Johnson", "Kim", "Lopez", "Nguyen", "Patel", "Smith", "Smyth"]
+def random_students (rng, count):
+    students = set()
+    while len(students) < count:
+        students.add((rng.choice(last_names) + str(rng.randint(1, 99)), rng.choice(first_names)))
+    return sorted(students)
+
+# Fill in a fraction of cells in a column (random unless given), leaving the rest empty, so some columns are too sparse to keep
+def random_fill (rng, count, make_value, fill = None):
+    if fill is None:
+        fill = rng.choice([0.05, 0.2, 0.5, 0.9, 1.0])
+    return [make_value() if rng.random() < fill else None for i in range(count)]
+
+# A random TSK export: five header rows (unit, lesson, title, category, date) then one row per student
+def make_tsk_export (rng, file_name):
+    students = random_students (rng, rng.randint(4, 30))
+    header = [[None] * 3 for i in range(5)]
+    columns = []
+    for unit in range(1, rng.randint(2, 4)):
+        first_in_unit = True
+        for lesson in ["1", "2", "3", "Q", "P", "RA", "T"][:rng.randint(2, 7)]:
+            for exercise in range(rng.randint(1, 4)):
+                header[0].append("Unit " + str(unit) + ": Unit title" if first_in_unit else None)
+                header[1].append("Lesson " + lesson + ": Lesson title" if exercise == 0 else None)
+                first_in_unit = False
+                assessment = len(columns) > 0 and (lesson in ["Q", "T"] or rng.random() < 0.2)
+                title = rng.choice(["Warm-up", "Practice Test 1", "Unit Lesson Check", "Coding problem"]) if assessment else "Coding problem"
+                header[2].append(title)
+                header[3].append("Assessment" if assessment else rng.choice(["Coding", "Warm-up"]))
+                header[4].append("9/" + str(rng.randint(1, 28)) + "/2022")
+                fill = None
+                if len(columns) == 0:
+                    # The aggregator only converts "a/b" cells from the second kept column on, so real exports always start with
+                    # a coding problem everyone has worked on; random "a/b" cells (or a column too sparse to keep) here would
+                    # just make most trials fail the same way
+                    make_value = lambda: rng.choice(["Turned In", "Turned In\n" + str(rng.randint(1, 40)) + " lines of code", "In progress"])
+                    fill = 1.0
+                elif assessment:
+                    points = rng.randint(1, 10)
+                    make_value = lambda: rng.choice([str(rng.randint(0, points)) + "/" + str(points),
+                                                     str(rng.randint(0, points)) + "/" + str(points) + " (" + str(rng.randint(0, 100)) + "%)",
+                                                     "In progress"])
+                else:
+                    make_value = lambda: rng.choice(["Turned In", "Turned In\n" + str(rng.randint(1, 40)) + " lines of code", "In progress",
+                                                     "In Progress", "Syntax error", "Turned In\nSyntax error on line 3",
+                                                     str(rng.randint(0, 5)) + "/5", str(rng.randint(0, 5)) + "/5 (with hints)"])
+                columns.append(random_fill (rng, len(students), make_value, fill))
+    rows = header
+    for i in range(len(students)):
+        rows.append([students[i][0], students[i][1], str(1000 + i)] + [column[i] for column in columns])
+    pd.DataFrame(rows).to_excel(file_name, header=False, index=False)
+    return students
+
+# Random STEM column headers the aggregators recognize, and ones they don't (which only some exports include, since
+# StemCspAggregator fails on them and that would keep most trials from reaching the grade calculation)
+csp_headers = ["Unit 1 Exercise {}", "Unit 2 Quiz {}", "Unit 3 Exam", "Unit 4 AP-Style Question {}", "Big Picture: Moore's Law {}",
+               "Big Picture: Data {}", "Password Milestone {}", "TEDx Final Project Submission {}", "tedxkinda: Talk {}",
+               "Question Type: Loops {}", "Mini Create Task {}", "Unit 0.5 Intro {}"]
+csp_unknown_headers = ["Bonus Survey {}", "Mystery column {}"]
+csa_headers = ["Unit 1: Lesson {} - Title", "Unit 2: Lesson {} - Title", "Unit 3 Quiz {}", "Assignment {}", "Unit 4 Exam {}",
+               "FRQ practice {}"]
+csa_unknown_headers = ["Unit 5 Survey {}", "Mystery column {}"]
+
+# A random STEM export: a "points possible" row, then one row per student
+def make_stem_export (rng, file_name, headers, unknown_headers):
+    if rng.random() < unknown_header_fraction:
+        headers = headers + unknown_headers
+    students = random_students (rng, rng.randint(4, 30))
+    columns = {"Student": ["Points Possible"] + [last + ", " + first for last, first in students],
+               "ID": [None] + [str(i) for i in range(len(students))],
+               "SIS User ID": [None] + [str(i) for i in range(len(students))],
+               "SIS Login ID": [None] + [str(i) for i in range(len(students))],
+               "Section": [None] + ["Section " + str(rng.randint(1, 3)) for i in range(len(students))]}
+    for i in range(rng.randint(3, 25)):
+        header = rng.choice(headers).format(i) + " (" + str(rng.randint(10000, 99999)) + ")"
+        points = rng.choice(["(read only)", "0", str(rng.randint(1, 20))])
+        possible = rng.randint(1, 20) if points in ["(read only)", "0"] else int(points)
+        columns[header] = [points] + random_fill (rng, len(students), lambda: rng.randint(0, possible))
+    pd.DataFrame(columns).to_csv(file_name, index=False)
+    return students
+
+# A random export for an aggregator; returns the students in it
+def make_export (rng, key, file_name):
+    if key == "tsk":
+        return make_tsk_export (rng, file_name)
+    if key == "csp":
+        return make_stem_export (rng, file_name, csp_headers, csp_unknown_headers)
+    return make_stem_export (rng, file_name, csa_headers, csa_unknown_headers)
+
+# Name of a random export file for an aggregator
+def export_file_name (key, dir):
+    return dir + os.path.sep + ("CS201 export.xlsx" if key == "tsk" else "2022 Grades-export.csv")
+
+# Compare two csv files cell by cell
+def compare_csv (reference_file, candidate_file, result):
+    with open(reference_file, newline="") as f:
+        reference_rows = list(csv.reader(f))
+    with open(candidate_file, newline="") as f:
+        candidate_rows = list(csv.reader(f))
+    compare_rows (reference_rows, candidate_rows, os.path.basename(candidate_file), result)
+
+# Compare two lists of rows cell by cell
+def compare_rows (reference_rows, candidate_rows, name, result):
+    if len(reference_rows) != len(candidate_rows):
+        result.mismatches.append(name + ": " + str(len(reference_rows)) + " rows in reference, " + str(len(candidate_rows)) + " in new")
+    for r in range(min(len(reference_rows), len(candidate_rows))):
+        if len(reference_rows[r]) != len(candidate_rows[r]):
+            result.mismatches.append(name + " row " + str(r) + ": " + str(len(reference_rows[r])) + " columns in reference, " + str(len(candidate_rows[r])) + " in new")
+        for c in range(min(len(reference_rows[r]), len(candidate_rows[r]))):
+            if reference_rows[r][c] != candidate_rows[r][c]:
+                result.mismatches.append(name + " row " + str(r) + " column " + str(c) + ": reference " + repr(reference_rows[r][c]) + ", new " + repr(candidate_rows[r][c]))
+
+# Run one version of an aggregator, returning how long it took and the exception it raised (as a string), if any
+def run_engine (function, args):
+    start = time.perf_counter()
+    try:
+        output = function(*args)
+        error = None
+    except Exception as e:
+        output = None
+        error = type(e).__name__ + ": " + str(e)
+        GradeUtils.trace (traceback.format_exc())
+    return output, time.perf_counter() - start, error
+
+# Compare the reference and new versions of an aggregator on one export file
+def compare_aggregate (reference, candidate, input_file, work_dir, description):
+    result = comparison(description)
+    reference_file = work_dir + os.path.sep + "reference.csv"
+    candidate_file = work_dir + os.path.sep + "new.csv"
+    # Remove the last trial's output, so a version that doesn't write any isn't compared on what it wrote last time
+    for file in [reference_file, candidate_file]:
+        if os.path.exists(file):
+            os.remove(file)
+    output, result.reference_time, reference_error = run_engine (reference, [input_file, reference_file])
+    output, result.candidate_time, candidate_error = run_engine (candidate, [input_file, candidate_file])
+    if reference_error != candidate_error:
+        result.mismatches.append("reference raised " + str(reference_error) + ", new raised " + str(candidate_error))
+    elif reference_error is not None:
+        result.error = "both raised " + reference_error
+    elif not os.path.exists(reference_file) and not os.path.exists(candidate_file):
+        result.error = "neither version wrote any output"
+    elif not os.path.exists(candidate_file):
+        result.mismatches.append("new wrote no output")
+    elif not os.path.exists(reference_file):
+        result.mismatches.append("reference wrote no output, new did")
+    else:
+        compare_csv (reference_file, candidate_file, result)
+    return result
+
+# Check a new version of an aggregator (called like TskAggregator.aggregate) against the reference on random exports
+def check_aggregator (key : str, candidate = None, trials : int = 20, seed : int = 0) -> list:
+    if candidate is None:
+        candidate = current_aggregators[key]
+    rng = random.Random(seed)
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="GradeEquivalence ")
+    try:
+        for trial in range(trials):
+            input_file = export_file_name (key, work_dir)
+            make_export (rng, key, input_file)
+            results.append(compare_aggregate (reference_aggregators[key], candidate, input_file, work_dir, key + " aggregate, trial " + str(trial)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+# A random Roster.csv for the students in an aggregate file. Some students get an alias, some get a misspelled name
+# (so they need fuzzy matching), some are left off, and some are auditing
+def make_roster (rng, students, file_name):
+    rows = []
+    for student_name in students:
+        last, first = student_name.split(", ", 1)
+        alias = ""
+        choice = rng.random()
+        if choice < 0.1:
+            continue
+        elif choice < 0.2:
+            alias = student_name
+            student_name = last + ", " + rng.choice(first_names)
+        elif choice < 0.3:
+            student_name = last + ", " + first[:-1] + first[-1].upper()     # Misspelled
+        elif choice < 0.35:
+            first = first + " M."                                           # Middle initial
+            student_name = last + ", " + first
+        rows.append([rng.choice([1, 2, 3, 4, 5, 6]), "audit" if rng.random() < 0.05 else "Comp Sci", student_name,
+                     rng.randint(100000, 999999), alias])
+    pd.DataFrame(rows, columns=["Period", "Course Title", "Student Name", "Sis Number", "Alias"]).to_csv(file_name, index=False)
+
+# Run one version of agg_to_synergy in its own copy of the working files; returns its output rows by file name
+def run_synergy_engine (function, agg_file, roster_file, due_dates, dir):
+    os.makedirs(dir)
+    shutil.copy(roster_file, dir + os.path.sep + GradeUtils.roster_file_name)
+    cwd = os.getcwd()
+    os.chdir(dir)
+    GradeUtils.roster_cache = (None, None)
+    try:
+        def due_date_callback (assignment_dict):
+            for assignment in assignment_dict:
+                assignment_dict[assignment] = due_dates.get(assignment, "")
+            return True
+        alias_callback = lambda ambiguous: {name: candidates[0] for name, candidates in ambiguous.items()}
+        files, elapsed, error = run_engine (function, [agg_file, dir, due_date_callback, alias_callback])
+    finally:
+        os.chdir(cwd)
+    outputs = {}
+    for file in files or []:
+        outputs[os.path.basename(file)] = [list(row) for row in load_workbook(file).active.iter_rows(values_only=True)]
+    return outputs, files, elapsed, error
+
+# Compare the reference and new versions of agg_to_synergy on one aggregate file
+def compare_synergy (candidate, agg_file, roster_file, due_dates, work_dir, description):
+    result = comparison(description)
+    reference_outputs, reference_files, result.reference_time, reference_error = run_synergy_engine (
+        GradeReference.agg_to_synergy, agg_file, roster_file, due_dates, work_dir + os.path.sep + "reference")
+    candidate_outputs, candidate_files, result.candidate_time, candidate_error = run_synergy_engine (
+        candidate, agg_file, roster_file, due_dates, work_dir + os.path.sep + "new")
+    if reference_error != candidate_error:
+        result.mismatches.append("reference raised " + str(reference_error) + ", new raised " + str(candidate_error))
+    elif reference_error is not None:
+        result.error = "both raised " + reference_error
+    elif (reference_files is None) != (candidate_files is None):
+        result.mismatches.append("reference returned " + str(reference_files) + ", new returned " + str(candidate_files))
+    elif reference_files is None or len(reference_files) == 0:
+        result.error = "neither version wrote any files"
+    else:
+        reference_names = [os.path.basename(file) for file in reference_files]
+        candidate_names = [os.path.basename(file) for file in candidate_files]
+        if reference_names != candidate_names:
+            result.mismatches.append("reference wrote " + str(reference_names) + ", new wrote " + str(candidate_names))
+        for name in reference_names:
+            if name in candidate_outputs:
+                compare_rows (reference_outputs[name], candidate_outputs[name], name, result)
+    return result
+
+# Check a new version of agg_to_synergy against the reference, using aggregates of random exports. The trials take turns
+# among the courses, since each one has its own assignment names and types (e.g., CSA's "Quiz and assignment")
+def check_synergy (candidate = None, trials : int = 20, seed : int = 0) -> list:
+    if candidate is None:
+        candidate = GradeUtils.agg_to_synergy
+    rng = random.Random(seed)
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="GradeEquivalence ")
+    try:
+        for trial in range(trials):
+            key = list(reference_aggregators)[trial % len(reference_aggregators)]
+            description = "agg_to_synergy, " + key + " trial " + str(trial)
+            trial_dir = work_dir + os.path.sep + str(trial)
+            os.makedirs(trial_dir)
+            input_file = export_file_name (key, trial_dir)
+            make_export (rng, key, input_file)
+            agg_file = trial_dir + os.path.sep + "Aggregated export.csv"
+            try:
+                reference_aggregators[key] (input_file, agg_file)
+            except Exception as e:
+                # Not every random export can be aggregated (check_aggregator covers those), so there's nothing to compare
+                result = comparison(description)
+                result.error = "couldn't make an aggregate file: " + type(e).__name__ + ": " + str(e)
+                results.append(result)
+                continue
+            agg = pd.read_csv(agg_file)
+            roster_file = trial_dir + os.path.sep + "Roster input.csv"
+            make_roster (rng, agg["Student"][1:].tolist(), roster_file)
+            # Some assignments are skipped (X, S or no date), but not so many that a STEM aggregate (which may only have a few
+            # assignments) usually has nothing left to import
+            due_dates = {}
+            for assignment in agg.columns[2:]:
+                if rng.random() < skipped_assignment_fraction:
+                    due_dates[assignment] = rng.choice(["X", "S", ""])
+                else:
+                    due_dates[assignment] = rng.choice(["9/" + str(rng.randint(1, 28)) + "/2022", "9/1/2022"])
+            results.append(compare_synergy (candidate, agg_file, roster_file, due_dates, trial_dir, description))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+# Check all of the current aggregators against the reference versions and print a report; returns True if they all match
+def main (args):
+    trials = int(args[0]) if len(args) > 0 else 20
+    seed = int(args[1]) if len(args) > 1 else 0
+    GradeUtils.print_func = lambda msg: None        # The aggregators' warnings about the random data are just noise here
+    checks = {}
+    for key in ["tsk", "csp", "csa"]:
+        checks[key + " aggregate"] = check_aggregator (key, None, trials, seed)
+    checks["agg_to_synergy"] = check_synergy (None, trials, seed)
+
+    ok = True
+    results = []
+    for check, check_results in checks.items():
+        for result in check_results:
+            print (result)
+        results += check_results
+    print ()
+    for check, check_results in checks.items():
+        compared = [result for result in check_results if result.compared()]
+        if len(compared) < min_compared_fraction * len(check_results):
+            print (check + ": only " + str(len(compared)) + " of " + str(len(check_results)) + " trials compared any output - too few to trust")
+            ok = False
+
+    failed = [result for result in results if not result.passed()]
+    compared = [result for result in results if result.compared()]
+    reference_time = sum(result.reference_time for result in compared)
+    candidate_time = sum(result.candidate_time for result in compared)
+    print (str(len([result for result in compared if result.passed()])) + " of " + str(len(results)) + " comparisons matched the reference, " +
+           str(len(failed)) + " failed, " + str(len(results) - len(compared)) + " were inconclusive")
+    if candidate_time > 0:
+        print ("Overall speedup: {:.2f}x".format(reference_time / candidate_time))
+    return ok and len(failed) == 0
+
+if __name__ == "__main__":
+    sys.exit(0 if main (sys.argv[1:]) else 1)
@@ -0,0 +1,398 @@
+"""
+GradeReference.py - frozen reference copies of the grade calculations, used by GradeEquivalence.py
+
+These are copies of TskAggregator.aggregate, StemCspAggregator.aggregate, StemCsaAggregator.aggregate and
+GradeUtils.agg_to_synergy as they were before any performance work, kept so faster replacements can be checked against
+them (see GradeEquivalence.py). Don't change these when changing the real aggregators - they are the definition of the
+grades a faster version must reproduce. Only change them if the grading rules themselves are meant to change.
+
+Reading the roster, matching student names and asking for due dates are not frozen; agg_to_synergy below uses the
+GradeUtils versions of those, so both engines see the same students and dates.
+"""
+
+# Libraries
+import pandas as pd
+import re
+import os
+import sys
+from typing import Callable
+from pandas import DataFrame, read_csv
+from openpyxl.utils.dataframe import dataframe_to_rows
+from openpyxl import Workbook
+import GradeUtils
+from GradeUtils import trace, println, roster_file_name
+
+# Category names used by the STEM aggregators (what they will be called in output aggregate file)
+csp_exercise_cat_name = "Exercises"
+csp_project_cat_name = "Project"
+csp_performance_cat_name = "Create task"
+csp_quiz_cat_name = "Quizzes"
+csp_exam_cat_name = "Exam"
+csa_exercise_cat_name = "Exercises"
+csa_quiz_cat_name = "Quiz and assignment"
+csa_exam_cat_name = "Exam"
+
+# Reference TskAggregator.aggregate
+def tsk_aggregate (input_file, output_file):
+    # Read the input file
+    df = pd.read_excel(input_file, header=None)
+
+    # There are six header rows; we'll extract the info we need, create column names based on that, and then remove the header rows
+    # In particular, we'll extract info from rows 0 (unit number), 1 (lesson number) and 3 (category)
+    # We don't use info in rows  2 (exercise title), 4 (date in was done in class), or 5
+    # We'll put the results (what we indend to be the column names) in a list called col_names
+    unit_num="0"
+    lesson=""
+    col_names = ["Last name", "First name", "ID"]   # The first three columns are fixed
+    # Parsing logic: A nan header value means "use the previous row value", and non-nan values needs parsing
+    for i in range (3, df.shape[1]):
+        if pd.isna(df.loc[0][i]) == False:
+            unit_num = df.loc[0][i][5]                          # Row 0 format is "Unit #: xxx", so 5th element is the actual #
+        if pd.isna(df.loc[1][i]) == False:
+            l = df.loc[1][i]                                    # Row 1 format is "Lesson #: xxx" - let's extract the lesson #
+            l = l.replace ("Lesson ", "")                       # Now we have just "#: xxx"
+            l = l[:l.find(":")]                                 # Now we have just "#"
+            if l == "Q":                                        # If a quiz, append Q to lesson number to lesson strings are ordered by due data
+                lesson += "Q"
+            elif l.isdigit() or l=="T":                         # If it's a numberic lesson number of test or quiz, create a new lesson name for aggregation 
+                lesson = unit_num + "." + l                     # We don't create new lesson aggregate names for the little "P" "PLx, "RA" exercises
+        if df.loc[3][i] == "Assessment":
+            if df.loc[2][i].startswith("Practice Test"):
+                col_names.append(lesson + " Assignment")        # Treat practice tests like assignments
+            elif df.loc[2][i].endswith("Lesson Check"):
+                col_names.append(lesson + " Assignment")        # Treat the lesson checks like assignments
+            elif lesson.endswith("T"):
+                col_names.append(lesson + " Exam")              # Lesson x.T assessments are exams
+            else:
+                col_names.append(lesson + " Quiz")              # Other assessments are lesson check or unit quizzes
+        else:
+            col_names.append(lesson + " Assignment")            # Everything else is an assignment
+
+    # Set the column names and drop the no-longer needed header rows    
+    df.columns = col_names
+    df.drop(labels=range(0,5), axis=0, inplace=True)
+
+    # Create an index column called "Student" of the form "last, first", drop the other three header columns
+    df.insert(0, "Student", df["Last name"].str.cat(df["First name"], sep=", "))
+    df.drop(columns=["Last name", "First name", "ID"], inplace=True)
+
+    # Keep those columns for which at least 1/4 the students have turned something in
+    df.dropna (axis=1, thresh=int(df.shape[0]/4), inplace=True) # Can change to how='all" instead of thresh to only drop if no one has turned something in
+
+    # Now let's clean up the cells - replacing text with numbers we can use for scoring
+    # Work columns are scored either 1 (submitted, no syntax errors, at least half the expected lines of code), else 0
+    # Assessment columns are scored based on number of questions answered correctly
+    df = df.fillna(0)                                                           # Not started = 0
+    df = df.replace(to_replace ='In progress', value = 0, regex = True)         # In progress = 0
+    df = df.replace(to_replace ='In Progress', value = 0, regex = True)         # In Progress = 0
+    df = df.replace(to_replace ='.*Syntax error.*', value = 0, regex = True)    # Syntax error = 0
+    df = df.replace(to_replace ='Turned In', value = 1, regex = True)           # Turned in = 1
+    df = df.replace(to_replace =' lines of code.*', value = "", regex = True)   # Remove text we don't need
+    df = df.replace(to_replace ='\n.*', value = "", regex = True)               # Remove text we don't need
+    df = df.replace(to_replace =' \(.+\)', value = "", regex = True)            # Remove text we don't need
+    
+    # Now all cells have numeric values except for a few cells of the form a/b
+    # For Work columns, transform to 1 if a/b > 1/2; else to 0
+    # If Assessment columns, transform to a, but remember that column is worth b points
+    # While doing this, keep track of the max points each row is work
+    # During the iteration, temporarily rename the columns so they have unique names
+    max_score = [1] * df.shape[1]   # By default, assume max points for a column is 1 (overridden below for assessment columns)
+    max_score[0] = "Max score"
+    columns = df.columns
+    df.columns = range(0, df.shape[1])
+    for c in df.columns[2:]:
+        for r in df.index:
+            val = df.loc[r][c]
+            if type(val) == str:
+                match = re.findall("\d+", val)
+                a = int(match[0])
+                b = int(match[1])
+                if columns[c].find("Assignment") != -1:
+                    if a/b >= .5:
+                        df.at[r,c] = 1    # Was df.loc[r][c] = 1
+                    else:
+                        df.at[r, c] = 0    # As above
+                else:
+                    df.at[r, c] = a        # Ass above
+                    max_score[c] = b
+    df.columns = columns
+
+    # Finally, add a header row that represents the max points that this row is worth
+    df.loc[0] = max_score
+    df = df.sort_index()
+    df.index = range (df.shape[0])
+
+    # Sum up all columns with the same name
+    df = df.set_index("Student")
+    df = df.apply(pd.to_numeric)    # Sanity check that all cells are numeric
+    df = df.groupby(by=df.columns, axis=1).sum()
+
+    # Add a dummy section column at the front
+    df.insert(0, "Section", ["Default"] * df.shape[0])
+
+    # Save the results to the output file
+    df.to_csv(output_file)
+
+# Reference StemCspAggregator.aggregate
+def csp_aggregate (input_file, output_file):
+    # Read the input file, drop the columns we don't need, and index on student name and section
+    df = pd.read_csv(input_file)                                # Read the file
+    df.drop(labels=["ID","SIS User ID", "SIS Login ID"], axis=1, inplace=True)   # Drop student ID columns
+    df = df.loc[:, df.iloc[0] != "(read only)"]                 # Drop STEM aggregates
+    df = df.loc[:, df.iloc[0] != "0"]                           # Drop unscored columns
+    df = df.set_index(["Student", "Section"])                   # Index on student name/section
+
+    # Change the column names to what we want to aggregate on: <unit #> <category>
+    col_names = df.columns.tolist()
+    for col_ix in range(len(col_names)):
+        col_name = col_names[col_ix].lower().replace("unit ", "")
+        new_col_name = None     # The new column name we will aggregate on
+        
+        # Most columns are exercises, quizzes, or exams starting with the unit number
+        match = re.search ("^(unit )*\d", col_name)
+        if match is not None:
+            if "exercise" in col_name or "ap-style" in col_name or "review" in col_name or "additional practice" in col_name:
+                new_col_name = match[0] + " " + csp_exercise_cat_name
+            elif "quiz" in col_name:
+                new_col_name = match[0] + " " + csp_quiz_cat_name
+            elif "exam" in col_name:
+                new_col_name = match[0] + " " + csp_exam_cat_name
+            elif "0.5 " in col_name or "0.6 " in col_name:
+                new_col_name = "1 " + csp_exercise_cat_name
+
+        # big picture exercises don't include the unit number - must figure it out from the name
+        elif "big picture" in col_name:
+            if "collaboration" in col_name:
+                new_col_name = "2 " + csp_exercise_cat_name
+            if "moore" in col_name:
+                new_col_name = "2 " + csp_exercise_cat_name
+            elif "reselling" in col_name:
+                new_col_name = "3 " + csp_exercise_cat_name
+            elif "ethics" in col_name or "intellectual" in col_name:
+                new_col_name = "4 " + csp_exercise_cat_name
+            elif "data" in col_name:
+                new_col_name = "5 " + csp_exercise_cat_name  
+            elif "innovation" in col_name or "divide" in col_name or "neutrality" in col_name:
+                new_col_name = "5 " + csp_exercise_cat_name
+
+        # projects don't include the unit number - must figure it out from the name
+        elif "milestone" in col_name or "final project submission" in col_name:
+            if "password" in col_name:
+                new_col_name = "2 " + csp_project_cat_name
+            elif "unintend" in col_name:
+                new_col_name = "3 " + csp_project_cat_name
+            elif "image" in col_name:
+                new_col_name = "4 " + csp_project_cat_name
+            elif "tedx" in col_name:
+                new_col_name = "5 " + csp_project_cat_name
+            elif "exploring" in col_name:
+                new_col_name = "6 " + csp_project_cat_name
+
+        # Some columns called "tedxkinda: xxx" that are just unit 5 exercises
+        elif "tedxkinda: " in col_name:
+            new_col_name = "5 " + csp_exercise_cat_name
+
+        # Columns wih the name "question type: " are unit 7 AP review exercises
+        elif "question type: " in col_name or "ap cb practice" in col_name:
+            new_col_name = "7 " + csp_exercise_cat_name
+
+        # And finally, the following are create-task assignments
+        if "create task" in col_name or "mini create" in col_name or "peer review" in col_name:
+            new_col_name = csp_performance_cat_name
+
+        # Some of the tedxkind
+        if new_col_name is None:
+            println ("Can't translate\t\t: " + col_name, file=sys.stderr)
+        else:
+            col_names[col_ix] = new_col_name
+            trace (new_col_name + "\t\t<- " + col_name)
+
+    df.columns = col_names
+
+    # Keep those columns for which at least 1/4 the students have turned something in
+    df.dropna (axis=1, thresh=int(df.shape[0]/4), inplace=True)
+
+    # Fill in na's with imputed values, using the mean value of the columns. This handled students
+    # who joined very late and didn't do initial work, or students who are a little late on recent assignments
+    # There should be none of these long term, as teachers should enter "0" grade at some point
+    #df = df.apply(lambda x: x.fillna(x.mean()),axis=0)
+
+    # Sum up all columns with the same name to produce aggregate points by unit and category
+    df = df.groupby(by=df.columns, axis=1).sum()
+
+    # Convert everything to an int, since imputed values create messy decimals
+    df = df.astype(int)
+    
+    # Save the results to the output file
+    df.to_csv(output_file)
+
+# Reference StemCsaAggregator.aggregate
+def csa_aggregate (input_file, output_file):
+    # Read the input file, drop the columns we don't need, and index on student name and section
+    df = pd.read_csv(input_file)                                # Read the file
+    df.drop(labels=["ID","SIS User ID", "SIS Login ID"], axis=1, inplace=True)   # Drop student ID columns
+    df = df.loc[:, df.iloc[0] != "(read only)"]                 # Drop STEM aggregates
+    df = df.loc[:, df.iloc[0] != "0"]                           # Drop unscored columns
+    df = df.set_index(["Student", "Section"])                   # Index on student name/section
+    df.dropna (axis=1, thresh=int(df.shape[0]/4), inplace=True) # Only keep columns if >1/4 students have submitted
+    #df = df.apply(lambda x: x.fillna(x.mean()),axis=0)          # Add imputed values for missing entries
+
+    # Change the column names to what we want to aggregate on: <unit #> <category>
+    # The category can be figured out based on a regular expression applied to the column name
+    # Unit number is always the first number in the text (for all categories)
+    cat_info = [
+        (csa_exam_cat_name, "^Unit \d+ Exam"),              # Unit N Exam (id)
+        (csa_exercise_cat_name, "^Unit \d+: Lesson"),       # Unit N: Lesson M - title (id)
+        (csa_quiz_cat_name, "^(Unit \d+ Quiz|Assignment)")  # Unit N Quiz (id) | Assignment N (id)
+    ]                
+
+    col_names = df.columns.tolist()
+    for col_ix in range(len(col_names)):
+        col_name = col_names[col_ix]
+        if col_name.startswith("FRQ"):
+            col_names[col_ix] = "drop me"
+            continue
+        match = re.search ("\d+", col_name)
+        if match is None:
+            println ("Warning: can't parse unit number from column " + col_name + ". Skipping....")
+            col_names[col_ix] = "drop me"
+            continue
+        unit_num = match[0]
+        category = None
+        for cat in cat_info:
+            if re.search(cat[1], col_name) is not None:
+                category = cat[0]
+                break
+        if category is None:
+            println ("Warning: can't parse category from column " + col_name + ". Skipping....")
+            col_names[col_ix] = "drop me"
+            continue
+        
+        new_col_name = unit_num + " " + category
+        col_names[col_ix] = new_col_name
+        trace (new_col_name + "\t\tWas: " + col_name)
+
+    df.columns = col_names
+
+    # drop all columns named "drop me"
+    df = df.loc[:, df.columns != "drop me"]
+
+    # Sum up all columns with the same name to produce aggregate points by unit and category
+    df = df.groupby(by=df.columns, axis=1).sum()
+
+    # Convert everything to an int, since imputed values create messy decimals
+    df = df.astype(int)
+
+    # Save the results to the output file and launch excel
+    df.to_csv(output_file)
+
+# Reference GradeUtils.get_assignment_type
+def get_assignment_type (course, assignment):
+    type = assignment.split(maxsplit=1)[-1]
+    if type in ["Assignment", "Exercises"]:
+        return "Assignment"
+    elif type in ["Quiz", "Quizzes", "Quiz and assignment"]:
+        return "Formative Assessment"
+    elif type == "Exam":
+        return "Summative Assessment"
+    elif type == "Project":
+        return "Projects"
+    elif type == "Create task" or assignment == "Create task":
+        return "Performance task"
+    else:
+        return None
+
+# Reference GradeUtils.agg_to_synergy (one period file at a time, written directly to its final name)
+def agg_to_synergy (input_file : str, output_dir : str, due_date_callback : Callable, alias_callback : Callable = None):
+    # Read in student roster info - we need to join this to the aggregated data
+    roster_dict = GradeUtils.get_roster_dict()
+    if roster_dict is None:
+        println (roster_file_name + " not found - skipping Synergy bulk import formatting")
+        return None
+    if len(roster_dict) == 0:
+        println (roster_file_name + " has no student roster info - skipping Synergy bulk import formatting")
+        return None
+
+    # Synergy requires separate bulk import files for each period a class is taught. We'll use a dictionary whose key is the period to keep track separately.
+    sdf_dict = {}   # Create a dictionary to hold a dataframe representing each 
+
+    # Open the input file and convert each of it's rows (one per student) to multiple synergy rows (one per assigment per student)
+    df = read_csv(input_file)
+    course = None
+    due_dates = None
+
+    # Match the platform's student names to the roster, fuzzy matching any that aren't an exact match
+    if alias_callback is None:
+        alias_callback = GradeUtils.confirm_aliases_console
+    student_dict = GradeUtils.resolve_student_names (df["Student"][1:], roster_dict, alias_callback)
+
+    for r in range(1, df.shape[0]):
+        row = df.iloc[r]
+        student = row["Student"]
+        if not student in student_dict:
+            println ("Warning: " + student + " not found in Roster.csv. Skipping them for now. Please add a row for them or an 'Alias' column entry to fix this issue")
+            continue
+        student_info = student_dict[student]
+        if student_info.course.lower() == "audit":
+            continue
+        elif course is None:
+            course = student_info.course
+        elif course != student_info.course:
+            println (roster_file_name + " maps students for this class into to multiple courses: " + course + " and " + student_info.course + " - skipping Synergy bulk import formatting")
+            return None
+
+        if due_dates is None:
+            if due_date_callback is None:
+                GradeUtils.get_assignment_due_dates_old (course, df.columns[2:])
+            else:
+                due_dates = GradeUtils.get_assignment_due_dates (course, df.columns[2:], due_date_callback)
+
+        for column_name in df.columns[2:]:
+            if column_name.strip() == "":       # A blank column is used to separate things that go in Synergy from aggregates of those things
+                break                           # We never want to import the "aggregates of aggregates" that follow
+            id = student_info.id
+            first_name = student_info.first_name
+            last_name = student_info.last_name
+            assignment_name = column_name
+            assignment_description = column_name
+            points = row[column_name]
+            if not str(points).isdigit():
+                println ("Can't parse points for " + assignment_name + " for " + first_name + " " + last_name + " - skipping Synergy bulk import formatting")
+                return None
+            max_points = df.iloc[0][column_name]
+            if not str(max_points).isdigit():
+                println ("Can't parse max_points for " + assignment_name + " - skipping Synergy bulk import formatting")
+                return None
+            overall_score = str(points) + "/" + str(max_points)
+            assignment_type = get_assignment_type (course, assignment_name)
+            if assignment_type is None:
+                println ("Can't parse assignment type for " + assignment_name + " - skipping Synergy bulk import formatting")
+                return None
+            assignment_date = due_dates[assignment_name]
+            if assignment_date in ["S", "X", ""]:
+                continue
+            output_row = [id, first_name, last_name, assignment_name, assignment_description, overall_score, max_points, assignment_type, assignment_date]
+            
+            period = student_info.period
+            if period not in sdf_dict:
+                # Make sure we have a dataframe (initially empty) to hold rows for each period
+                sdf = DataFrame()
+                for col in ["STUDENT_PERM_ID", "STUDENT_FIRST_NAME", "STUDENT_LAST_NAME", "ASSIGNMENT_NAME", "ASSIGNMENT_DESCRIPTION",
+                            "OVERALL_SCORE", "POINTS", "ASSIGNMENT_TYPE", "ASSIGNMENT_DATE"]:
+                    sdf[col] = ""
+                sdf_dict[period] = sdf
+            sdf = sdf_dict[period]
+            sdf.loc[len(sdf.index)] = output_row
+
+    output_files = []
+    for period in sdf_dict:
+        sdf = sdf_dict[period]
+        output_file = output_dir + os.path.sep + "Synergy bulk import for P" + str(period) + " " + course + ".xlsx"
+        wb = Workbook()
+        ws = wb.active
+        for r in dataframe_to_rows(sdf, index=False, header=True):
+            ws.append(r)
+        wb.save(output_file)
+        output_files.append(output_file)
+    
+    return output_files
@@ -0,0 +1,363 @@
+"""
+GradeService.py - a resident local service that keeps Python, pandas, openpyxl and the roster loaded between aggregations
+
+Every launch of GradeAggregator.pyw otherwise pays for starting Python, importing pandas and openpyxl, and parsing Roster.csv
+before it can do any work. Leave this service running (e.g., "pythonw GradeService.py", or add a shortcut to your startup folder)
+and GradeAggregator.pyw will hand its work to it, so results come back in about the time the aggregation itself takes.
+If the service isn't running, GradeAggregator.pyw just aggregates locally like it always has.
+
+The service only listens on localhost, and accepts JSON POST requests:
+* /aggregate {"aggregator": "tsk" | "csp" | "csa", "input_file": <path, or omit for the latest export in the download folder>}
+    Returns {"input_file": ..., "agg_file": ..., "messages": [...]}
+    Instead of a path, an export file can be uploaded as the request body (any non-JSON content type) to
+    /aggregate?aggregator=<name>&file_name=<export file name>
+* /synergy {"agg_file": <path>, "aliases": {<name>: <sis number>}, "due_dates": {<assignment>: <date>}}
+    Returns {"files": [...], "messages": [...]}, or {"needs": "aliases" | "due_dates", ...} if the teacher needs to be asked
+    something first; the client asks and resends the request with "aliases"/"due_dates" filled in
+* /status - returns {"status": "ok"}
+Any request may instead return {"error": ..., "messages": [...]}
+
+Every request (uploads included) must send the service's access token in an "X-GradeService-Token" header. The service
+makes a new random token each time it starts and writes it to "GradeService token" in the user's local app data folder
+(home directory elsewhere), which only that user can read. That keeps other users of a shared PC, and web pages open in
+a browser, from reading student names and IDs or running jobs through the service.
+
+Jobs run on a small worker pool; if too many jobs are already waiting, requests are turned away with a "busy" error.
+
+Usage:
+    python GradeService.py                          - run the service
+    python GradeService.py <aggregator> [file]      - aggregate via the running service (aggregator is tsk, csp or csa)
+"""
+
+import sys
+import os
+import json
+import threading
+import traceback
+import secrets
+import hmac
+import urllib.request
+import urllib.error
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import GradeUtils
+
+# Configuration variables
+service_port = 8745         # Localhost port the service listens on
+worker_count = 2            # Number of aggregation jobs that can run at once
+queue_size = 8              # Number of jobs that can wait for a worker before requests are turned away
+upload_dir_name = "GradeService uploads"    # Subdirectory of the download folder that uploaded export files are saved to
+token_header = "X-GradeService-Token"       # Request header clients put the access token in
+
+# The file the service's access token is written to. The local app data folder is private to the user on Windows
+def get_token_file_name ():
+    dir = os.getenv("LOCALAPPDATA") or os.path.expanduser("~")
+    return dir + os.path.sep + "GradeService token"
+
+# Make a new access token and save it where only this user can read it
+def write_token () -> str:
+    token = secrets.token_hex(32)
+    file_name = get_token_file_name()
+    fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    os.chmod(file_name, 0o600)     # In case the file already existed with looser permissions
+    return token
+
+# Client side: read the running service's access token (None if the service has never been started)
+def read_token ():
+    try:
+        with open(get_token_file_name()) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+# The aggregators the service knows about. They are imported when first used so clients of the service don't need pandas
+def get_aggregator (key : str):
+    if key == "tsk":
+        from TskAggregator import TskAggregator
+        return TskAggregator()
+    elif key == "csp":
+        from StemCspAggregator import StemCspAggregator
+        return StemCspAggregator()
+    elif key == "csa":
+        from StemCsaAggregator import StemCsaAggregator
+        return StemCsaAggregator()
+    return None
+
+# Raised from the agg_to_synergy callbacks when the client must ask the teacher something before the job can finish
+class ClientInputNeeded(Exception):
+    def __init__ (self, response : dict):
+        super().__init__(response["needs"])
+        self.response = response
+
+# Messages printed while running a job are collected per thread, so they can be returned to the client that asked for the job
+job_messages = threading.local()
+def service_println (msg):
+    print (msg)
+    if getattr(job_messages, "messages", None) is not None:
+        job_messages.messages.append(msg)
+
+# Run the aggregator on an input file; returns the response for the client
+def run_aggregate (request : dict) -> dict:
+    aggregator = get_aggregator (request.get("aggregator"))
+    if aggregator is None:
+        return {"error": "Unknown aggregator: " + str(request.get("aggregator"))}
+    input_file = request.get("input_file")
+    if input_file is None:
+        input_file = aggregator.get_default_input_file()
+        if input_file is None:
+            return {"error": "No files to aggregate with path: \"" + aggregator.get_input_file_pattern () + "\"."}
+    if not os.path.exists(input_file):
+        return {"error": "File not found: " + input_file}
+
+    GradeUtils.println ("Running " + aggregator.name())
+    GradeUtils.println ("Processing " + input_file)
+    agg_file = GradeUtils.get_output_file_name(input_file, "Aggregated ")
+    aggregator.aggregate(input_file, agg_file)
+    return {"input_file": input_file, "agg_file": agg_file}
+
+# Roster.csv and Assignment_due_dates.csv are shared by all jobs, so only one job at a time gets to do Synergy formatting
+synergy_lock = threading.Lock()
+
+# Convert an aggregate file to Synergy bulk import files; returns the response for the client
+def run_synergy (request : dict) -> dict:
+    agg_file = request.get("agg_file")
+    if agg_file is None or not os.path.exists(agg_file):
+        return {"error": "File not found: " + str(agg_file)}
+    if not GradeUtils.synergy_import_configured():
+        return {"error": "Synergy bulk import aggregation not configured"}
+
+    # The teacher's picks for students that weren't found in the roster, as platform name -> Sis Number ("" to skip them)
+    def alias_callback (ambiguous : dict) -> dict:
+        aliases = request.get("aliases")
+        if aliases is None:
+            candidates = {}
+            for name, students in ambiguous.items():
+                candidates[name] = [{"id": s.id, "first_name": s.first_name, "last_name": s.last_name,
+                                     "period": str(s.period), "course": s.course} for s in students]
+            raise ClientInputNeeded ({"needs": "aliases", "candidates": candidates})
+        confirmed = {}
+        for name, students in ambiguous.items():
+            for s in students:
+                if aliases.get(name) == s.id:
+                    confirmed[name] = s
+        return confirmed
+
+    # The teacher's due dates for each assignment
+    def due_date_callback (due_dates : dict) -> bool:
+        new_dates = request.get("due_dates")
+        if new_dates is None:
+            dates = {}
+            for assignment, due_date in due_dates.items():
+                dates[assignment] = due_date if isinstance(due_date, str) else ""
+            raise ClientInputNeeded ({"needs": "due_dates", "due_dates": dates})
+        for assignment in due_dates:
+            if assignment in new_dates:
+                due_dates[assignment] = new_dates[assignment]
+        return True
+
+    output_dir = GradeUtils.get_synergy_output_dir(agg_file)
+    with synergy_lock:
+        files = GradeUtils.agg_to_synergy (agg_file, output_dir, due_date_callback, alias_callback)
+    if files is None or len(files) == 0:
+        return {"error": "Failed to create synergy bulk import file from aggregation file"}
+    return {"files": files}
+
+# Run a job on a worker thread, capturing its messages and any errors in the response
+def run_job (job, request : dict) -> dict:
+    job_messages.messages = []
+    try:
+        response = job(request)
+    except ClientInputNeeded as e:
+        response = e.response
+    except Exception:
+        response = {"error": traceback.format_exc()}
+    response["messages"] = job_messages.messages
+    job_messages.messages = None
+    return response
+
+# Handles the HTTP requests, handing the actual work to the worker pool
+class GradeServiceHandler(BaseHTTPRequestHandler):
+    jobs = {"/aggregate": run_aggregate, "/synergy": run_synergy}
+
+    def send_json (self, status : int, response : dict):
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Check the request has the service's access token, and turn it away if not
+    def authorized (self) -> bool:
+        token = self.headers.get(token_header, "")
+        if hmac.compare_digest(token.encode("utf-8"), self.server.token.encode("utf-8")):
+            return True
+        self.send_json (403, {"error": "Missing or wrong " + token_header + " header"})
+        return False
+
+    def do_GET (self):
+        if not self.authorized():
+            return
+        if self.path == "/status":
+            self.send_json (200, {"status": "ok"})
+        else:
+            self.send_json (404, {"error": "Unknown request: " + self.path})
+
+    def do_POST (self):
+        if not self.authorized():
+            return
+        url = urllib.parse.urlparse(self.path)
+        if url.path not in self.jobs:
+            self.send_json (404, {"error": "Unknown request: " + self.path})
+            return
+        is_json = self.headers.get("Content-Type", "").startswith("application/json")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError("negative Content-Length")
+            body = self.rfile.read(length)
+            if is_json:
+                request = json.loads(body)
+                if not isinstance(request, dict):
+                    raise ValueError("expected a JSON object")
+        except ValueError as e:     # Bad Content-Length, or a body that isn't a JSON object (json errors are ValueErrors too)
+            self.send_json (400, {"error": "Bad request: " + str(e)})
+            return
+        if not is_json:
+            request = self.save_upload (url, body)
+            if request is None:
+                self.send_json (400, {"error": "Uploads need aggregator and file_name query parameters"})
+                return
+
+        # Bounded queue: only take the job if there is a worker or a queue slot free for it
+        if not self.server.job_slots.acquire(blocking=False):
+            self.send_json (503, {"error": "GradeService is busy - try again shortly"})
+            return
+        try:
+            response = self.server.pool.submit(run_job, self.jobs[url.path], request).result()
+        finally:
+            self.server.job_slots.release()
+        self.send_json (200, response)
+
+    # Save an uploaded export file, returning the equivalent /aggregate request
+    def save_upload (self, url, body : bytes):
+        query = urllib.parse.parse_qs(url.query)
+        if "aggregator" not in query or "file_name" not in query:
+            return None
+        upload_dir = GradeUtils.get_download_dir() + os.path.sep + upload_dir_name
+        os.makedirs(upload_dir, exist_ok=True)
+        input_file = upload_dir + os.path.sep + os.path.basename(query["file_name"][0])
+        with open(input_file, "wb") as f:
+            f.write(body)
+        return {"aggregator": query["aggregator"][0], "input_file": input_file}
+
+    def log_message (self, format, *args):
+        GradeUtils.trace (format % args)
+
+# Run the service until it's killed
+def serve ():
+    # Roster.csv and Assignment_due_dates.csv live next to the scripts, so run from there
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    GradeUtils.print_func = service_println
+
+    # Warm up: import the aggregators (and so pandas and openpyxl), parse the roster, and start the Synergy file writers
+    for key in ["tsk", "csp", "csa"]:
+        get_aggregator (key)
+    import openpyxl
+    if GradeUtils.synergy_import_configured():
+        GradeUtils.get_roster_dict()
+        GradeUtils.start_writer_pool()
+
+    server = ThreadingHTTPServer(("127.0.0.1", service_port), GradeServiceHandler)
+    server.pool = ThreadPoolExecutor(max_workers=worker_count)
+    server.job_slots = threading.BoundedSemaphore(worker_count + queue_size)
+    server.token = write_token()    # Only once we have the port, so we don't replace the token of a service already running
+    print ("GradeService listening on http://127.0.0.1:" + str(service_port))
+    server.serve_forever()
+
+# Client side: send a request to the service and return its response
+def post (path : str, request : dict) -> dict:
+    data = json.dumps(request).encode("utf-8")
+    http_request = urllib.request.Request("http://127.0.0.1:" + str(service_port) + path, data=data,
+                                          headers={"Content-Type": "application/json", token_header: read_token() or ""})
+    try:
+        with urllib.request.urlopen(http_request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read())
+
+# Client side: check whether the service is running
+def service_running () -> bool:
+    token = read_token()
+    if token is None:
+        return False
+    http_request = urllib.request.Request("http://127.0.0.1:" + str(service_port) + "/status", headers={token_header: token})
+    try:
+        with urllib.request.urlopen(http_request, timeout=0.5) as response:
+            return json.loads(response.read()).get("status") == "ok"
+    except (OSError, ValueError):
+        return False
+
+# Client side: aggregate an input file (or the latest export if input_file is None)
+def submit_aggregate (aggregator : str, input_file : str) -> dict:
+    request = {"aggregator": aggregator}
+    if input_file is not None:
+        request["input_file"] = os.path.abspath(input_file)
+    return post ("/aggregate", request)
+
+# Client side: convert an aggregate file to Synergy bulk import files
+# alias_callback and due_date_callback are called (like they are by GradeUtils.agg_to_synergy) if the service needs the teacher's input
+# Each round that stops to ask the teacher something still runs part of the job (e.g., saving confirmed aliases), so the
+# messages from every round are returned; each round starts the job over, so messages an earlier round already gave are left out
+def submit_synergy (agg_file : str, due_date_callback, alias_callback) -> dict:
+    request = {"agg_file": agg_file}
+    messages = []
+    while True:
+        response = post ("/synergy", request)
+        messages += [msg for msg in response.get("messages", []) if msg not in messages]
+        if response.get("needs") == "aliases":
+            ambiguous = {}
+            for name, candidates in response["candidates"].items():
+                ambiguous[name] = [GradeUtils.student(c["period"], c["course"], c["last_name"] + ", " + c["first_name"], c["id"], None)
+                                   for c in candidates]
+            confirmed = alias_callback (ambiguous)
+            request["aliases"] = {name: confirmed[name].id if name in confirmed else "" for name in ambiguous}
+        elif response.get("needs") == "due_dates":
+            due_dates = response["due_dates"]
+            due_date_callback (due_dates)
+            request["due_dates"] = due_dates
+        else:
+            response["messages"] = messages
+            return response
+
+# Command line client: aggregate via the running service and print where the output went
+def main (args):
+    if len(args) == 0:
+        serve ()
+        return
+    if not service_running():
+        print ("GradeService is not running; start it with \"python GradeService.py\"")
+        return
+    response = submit_aggregate (args[0], args[1] if len(args) > 1 else None)
+    for msg in response["messages"]:
+        print (msg)
+    if "error" in response:
+        print (response["error"])
+        return
+    print ("Aggregate file: " + response["agg_file"])
+
+    # Use the saved due dates; new assignments are left out until dates are added (e.g., via GradeAggregator.pyw)
+    response = submit_synergy (response["agg_file"], lambda due_dates: False, GradeUtils.confirm_aliases_console)
+    for msg in response["messages"]:
+        print (msg)
+    if "error" in response:
+        print (response["error"])
+        return
+    for file in response["files"]:
+        print ("Synergy bulk import file: " + file)
+
+if __name__ == "__main__":
+    main (sys.argv[1:])
@@ -6,15 +6,18 @@ Author: Marc Shepard
 from operator import index
 import sys
 import os
+import re
 import glob
 import winreg
 import subprocess
 import datetime
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from typing import Callable, OrderedDict
-from pandas import DataFrame, read_csv
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl import Workbook
 from collections import OrderedDict
+# pandas and openpyxl are slow to import, so they are imported by the functions that use them; that way thin clients of
+# GradeService.py (like GradeAggregator.pyw when the service is running) only pay for them if they aggregate locally
 
 # Configuration variables
 roster_file_name = "Roster.csv"     # File to persist due dates for Synergy bulk import format files
@@ -85,6 +88,7 @@ def is_date (text):
 # We'll ask the teacher and persist the data in "Assignment_due_dates.csv"
 # As a future enhancement, we should auto-generate this for TSK rather than ask (but for STEM we always need to ask)
 def get_assignment_due_dates (course : str, assignments : list[str], callback : Callable) -> dict:
+    from pandas import DataFrame, read_csv
     # If the file "<course> due dates.csv" doesn't exist, create it
     file_name = "Assignment_due_dates.csv"
     if not os.path.exists(file_name):
@@ -132,6 +136,7 @@ def get_assignment_due_dates (course : str, assignments : list[str], callback :
 # We'll ask teachers to supply the dates when we see new assignments for the first time
 # As a future enhancement, we should auto-generate this for TSK rather than ask (but for STEM we always need to ask)
 def get_assignment_due_dates_old (course, assignments):
+    from pandas import DataFrame, read_csv
     # If the file "<course> due dates.csv" doesn't exist, create it
     file_name = course + " due dates.csv"
     if not os.path.exists(file_name):
@@ -208,8 +213,18 @@ def synergy_import_configured():
 def get_synergy_output_dir(input_file):
     return os.path.dirname(input_file)
 
+# The last roster read, and the time Roster.csv was modified when it was read; long-running processes (GradeService.py)
+# reuse it until Roster.csv changes rather than re-parsing it for every aggregation
+roster_cache = (None, None)
+
 # Get a dictionary of students info from student name from the roster csv file
 def get_roster_dict():
+    global roster_cache
+    from pandas import read_csv
+    mtime = os.path.getmtime(roster_file_name)
+    if roster_cache[0] == mtime:
+        return roster_cache[1]
+
     roster_dict = {}
 
     df = read_csv(roster_file_name)
@@ -226,8 +241,167 @@ def get_roster_dict():
             s = student(row["Period"], row["Course Title"], row["Student Name"], row["Sis Number"], None)
         roster_dict[s.alias] = s
 
+    roster_cache = (mtime, roster_dict)
     return roster_dict
 
+# Character n-gram index over roster names, used to suggest roster matches for platform names that don't exactly match
+# Names are normalized (lower case, letters and digits only, name parts sorted) so "Smith, Jon" and "Jon Smith" look the same
+# Lookups only visit roster names sharing at least one n-gram with the query, rather than scanning the whole roster
+class roster_index:
+    def __init__(self, roster_dict, n = 3):
+        self.n = n
+        self.names = {}         # Normalized name -> list of students with that name
+        self.grams = {}         # Normalized name -> set of n-grams for that name
+        self.postings = {}      # n-gram -> set of normalized names containing it
+        for alias, s in roster_dict.items():
+            self.add(alias, s)
+            self.add(s.last_name + ", " + s.first_name, s)
+
+    # Lower case, drop punctuation, and sort the name parts so first/last order doesn't matter
+    @staticmethod
+    def normalize(name):
+        parts = re.findall("[a-z0-9]+", str(name).lower())
+        return " ".join(sorted(parts))
+
+    # Like normalize, but apostrophes and periods are dropped rather than splitting the name ("O'Brien" -> "obrien"), and a
+    # trailing middle initial is ignored ("Smith, Jon M." -> "jon smith"). Two names with the same key are the same name
+    # written differently; any other difference (even one letter) may be a different student
+    @staticmethod
+    def name_key(name):
+        parts = re.findall("[a-z0-9]+", re.sub("['\u2019.]", "", str(name).lower()))
+        if len(parts) > 2 and len(parts[-1]) == 1:
+            parts = parts[:-1]
+        return " ".join(sorted(parts))
+
+    # The set of n-grams for a normalized name, padded so short names and word boundaries still produce n-grams
+    def get_grams(self, normalized_name):
+        padded = " " + normalized_name + " "
+        return {padded[i:i+self.n] for i in range(max(1, len(padded) - self.n + 1))}
+
+    def add(self, name, s):
+        key = roster_index.normalize(name)
+        if key == "":
+            return
+        if key in self.names:
+            if s not in self.names[key]:
+                self.names[key].append(s)
+            return
+        self.names[key] = [s]
+        self.grams[key] = self.get_grams(key)
+        for gram in self.grams[key]:
+            self.postings.setdefault(gram, set()).add(key)
+
+    # Return up to max_results (score, student) tuples, best first. Score is the Dice coefficient of the two n-gram sets (0..1)
+    def lookup(self, name, max_results = 5):
+        query = self.get_grams(roster_index.normalize(name))
+        shared = {}
+        for gram in query:
+            for key in self.postings.get(gram, ()):
+                shared[key] = shared.get(key, 0) + 1
+        # The same student may be indexed under both an alias and their roster name; only keep their best score
+        best = {}
+        for key, count in shared.items():
+            score = 2 * count / (len(query) + len(self.grams[key]))
+            for s in self.names[key]:
+                if s.id not in best or score > best[s.id][0]:
+                    best[s.id] = (score, s)
+        return sorted(best.values(), key=lambda match: match[0], reverse=True)[:max_results]
+
+# Build the fuzzy-match index alongside the roster dictionary (reusing the last one built if the roster hasn't changed)
+roster_index_cache = (None, None)
+def get_roster_index(roster_dict):
+    global roster_index_cache
+    if roster_index_cache[0] is not roster_dict:
+        roster_index_cache = (roster_dict, roster_index(roster_dict))
+    return roster_index_cache[1]
+
+# Threshold for fuzzy name matching: roster students scoring at least suggest_match_score are queued for the teacher to confirm
+# (unless one is the same name written differently, which is used automatically; see resolve_student_names)
+suggest_match_score = 0.4
+
+# Ask the teacher on the console to confirm ambiguous matches. ambiguous maps a platform name to a list of candidate students.
+# Returns a dictionary of platform name -> the chosen student (names the teacher didn't pick a student for are left out)
+def confirm_aliases_console (ambiguous : dict) -> dict:
+    confirmed = {}
+    for name, candidates in ambiguous.items():
+        print (name + " was not found in " + roster_file_name + ". Did you mean:")
+        for i in range(len(candidates)):
+            print ("  " + str(i+1) + ". " + candidates[i].last_name + ", " + candidates[i].first_name + "\tP" + str(candidates[i].period) + " " + candidates[i].course)
+        choice = input ("Enter a number to pick a student, or CR to skip them: ").strip()
+        if choice.isdigit() and 1 <= int(choice) <= len(candidates):
+            confirmed[name] = candidates[int(choice)-1]
+    return confirmed
+
+# Save confirmed platform names in the Alias column of the roster, so future runs match them exactly
+# The Alias column only holds one name, so students that already have an alias are left alone (and the teacher is told)
+def save_aliases (confirmed : dict):
+    from pandas import read_csv
+    df = read_csv(roster_file_name)
+    if "Alias" not in df.columns:
+        df["Alias"] = ""
+    df["Alias"] = df["Alias"].astype(object)
+    changed = False
+    for name, s in confirmed.items():
+        for index in df.index:
+            if str(df.at[index, "Sis Number"]) != s.id:
+                continue
+            alias = df.at[index, "Alias"]
+            if not isinstance(alias, str) or alias == "":
+                df.at[index, "Alias"] = name
+                changed = True
+            elif alias != name:
+                println ("Couldn't save " + name + " as an alias for " + s.last_name + ", " + s.first_name + ": they already have the alias \"" +
+                         alias + "\" in " + roster_file_name + ". You'll be asked about " + name + " again until one of the names is changed to match")
+    if changed:
+        println ("Saving confirmed aliases to \"" + roster_file_name + "\"")
+        df.to_csv(roster_file_name, index=False)
+
+# Map each platform student name to a roster student. Exact matches are used as is; otherwise the roster index finds close
+# matches, which are sent to alias_callback in one batch for the teacher to confirm. A wrong match would put one student's
+# grades on another student's record, and names a letter apart ("Garcia, Maria" and "Garcia, Mario") are often different
+# students, so a match is only used without asking if it's the only roster student with the same name, ignoring order,
+# punctuation and a trailing middle initial (see roster_index.name_key), is in the same course as the exactly matched
+# students, and isn't already matched to another name. Names that can't be resolved are left out of the returned dictionary
+def resolve_student_names (names, roster_dict : dict, alias_callback : Callable) -> dict:
+    resolved = {}
+    claimed = set()     # Sis Numbers of roster students that a platform name has already been matched to
+    courses = set()     # Courses of the exactly matched students
+    unmatched = []
+    for name in names:
+        if name in resolved or name in unmatched:
+            continue
+        if name in roster_dict:
+            resolved[name] = roster_dict[name]
+            claimed.add(roster_dict[name].id)
+            courses.add(roster_dict[name].course)
+        else:
+            unmatched.append(name)
+
+    ambiguous = OrderedDict()
+    for name in unmatched:
+        matches = [m for m in get_roster_index(roster_dict).lookup(name) if m[0] >= suggest_match_score]
+        if len(matches) == 0:
+            continue
+        key = roster_index.name_key(name)
+        same_name = [m[1] for m in matches if key in [roster_index.name_key(m[1].alias), roster_index.name_key(m[1].last_name + ", " + m[1].first_name)]]
+        s = same_name[0] if len(same_name) == 1 else None
+        if s is not None and s.id not in claimed and s.course in courses:
+            println ("Matched " + name + " to " + s.last_name + ", " + s.first_name + " in " + roster_file_name)
+            resolved[name] = s
+            claimed.add(s.id)
+        else:
+            # Unclaimed students in this class's course are the likeliest picks, so list them first
+            candidates = [m[1] for m in matches]
+            ambiguous[name] = sorted(candidates, key=lambda c: c.id in claimed or c.course not in courses)
+
+    if len(ambiguous) > 0:
+        confirmed = alias_callback (ambiguous)
+        if len(confirmed) > 0:
+            resolved.update(confirmed)
+            save_aliases (confirmed)
+
+    return resolved
+
 def get_assignment_type (course, assignment):
     type = assignment.split(maxsplit=1)[-1]
     if type in ["Assignment", "Exercises"]:
@@ -243,8 +417,47 @@ def get_assignment_type (course, assignment):
     else:
         return None
 
+# Worker processes used to write Synergy bulk import files (one file per period). openpyxl builds the spreadsheet XML in
+# pure Python, which holds the GIL, so threads can't write files in parallel but processes can. Starting the workers takes
+# about a second, though (more on Windows), which is more than writing a typical class's files takes; so the pool is only used
+# once it exists (GradeService.py starts it up front and keeps it) or when there are enough rows to pay for starting it
+writer_count = min(4, os.cpu_count() or 1)
+writer_pool_min_rows = 20000    # Synergy rows needed before it's worth starting the writer processes for a single run
+writer_pool = None
+
+# The writer pool, starting a new one if there isn't one yet or a worker died (e.g., was killed) and broke the last one
+def get_writer_pool ():
+    global writer_pool
+    if writer_pool is None or writer_pool._broken:
+        if writer_pool is not None:
+            writer_pool.shutdown(wait=False, cancel_futures=True)
+        writer_pool = ProcessPoolExecutor(max_workers=writer_count)
+    return writer_pool
+
+# Start the writer processes now, so the first Synergy run doesn't wait for them (used by long-running processes like GradeService.py)
+def start_writer_pool ():
+    pool = get_writer_pool()
+    wait([pool.submit(os.getpid) for i in range(writer_count)])
+
+# A temporary file name in the same directory as file_name, so it can be renamed to file_name atomically once written
+def get_temp_file_name (file_name):
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(file_name), prefix="~", suffix=".tmp")
+    os.close(fd)
+    return temp_file
+
+# Save one period's rows (a list of rows, header first) as a Synergy bulk import spreadsheet. Runs in a writer process
+def write_synergy_file (rows, file_name):
+    from openpyxl import Workbook
+    wb = Workbook()
+    ws = wb.active
+    for r in rows:
+        ws.append(r)
+    wb.save(file_name)
+
 # Convert a grade aggregate spreadsheet into Synergy bulk import format
-def agg_to_synergy (input_file : str, output_dir : str, due_date_callback : Callable):
+def agg_to_synergy (input_file : str, output_dir : str, due_date_callback : Callable, alias_callback : Callable = None):
+    from pandas import read_csv
+
     # Read in student roster info - we need to join this to the aggregated data
     roster_dict = get_roster_dict()
     if roster_dict is None:
@@ -255,20 +468,27 @@ def agg_to_synergy (input_file : str, output_dir : str, due_date_callback : Call
         return None
 
     # Synergy requires separate bulk import files for each period a class is taught. We'll use a dictionary whose key is the period to keep track separately.
-    sdf_dict = {}   # Create a dictionary to hold a dataframe representing each 
+    # Each period's rows are kept as a plain list (header first); appending to a DataFrame a row at a time copies it every time
+    rows_dict = {}
+    row_count = 0
 
     # Open the input file and convert each of it's rows (one per student) to multiple synergy rows (one per assigment per student)
     df = read_csv(input_file)
     course = None
     due_dates = None
 
+    # Match the platform's student names to the roster, fuzzy matching any that aren't an exact match
+    if alias_callback is None:
+        alias_callback = confirm_aliases_console
+    student_dict = resolve_student_names (df["Student"][1:], roster_dict, alias_callback)
+
     for r in range(1, df.shape[0]):
         row = df.iloc[r]
         student = row["Student"]
-        if not student in roster_dict:
+        if not student in student_dict:
             println ("Warning: " + student + " not found in Roster.csv. Skipping them for now. Please add a row for them or an 'Alias' column entry to fix this issue")
             continue
-        student_info = roster_dict[student]
+        student_info = student_dict[student]
         if student_info.course.lower() == "audit":
             continue
         elif course is None:
@@ -308,27 +528,48 @@ def agg_to_synergy (input_file : str, output_dir : str, due_date_callback : Call
             if assignment_date in ["S", "X", ""]:
                 continue
             output_row = [id, first_name, last_name, assignment_name, assignment_description, overall_score, max_points, assignment_type, assignment_date]
-            
+
             period = student_info.period
-            if period not in sdf_dict:
-                # Make sure we have a dataframe (initially empty) to hold rows for each period
-                sdf = DataFrame()
-                for col in ["STUDENT_PERM_ID", "STUDENT_FIRST_NAME", "STUDENT_LAST_NAME", "ASSIGNMENT_NAME", "ASSIGNMENT_DESCRIPTION",
-                            "OVERALL_SCORE", "POINTS", "ASSIGNMENT_TYPE", "ASSIGNMENT_DATE"]:
-                    sdf[col] = ""
-                sdf_dict[period] = sdf
-            sdf = sdf_dict[period]
-            sdf.loc[len(sdf.index)] = output_row
-
-    output_files = []
-    for period in sdf_dict:
-        sdf = sdf_dict[period]
-        output_file = output_dir + os.path.sep + "Synergy bulk import for P" + str(period) + " " + course + ".xlsx"
-        wb = Workbook()
-        ws = wb.active
-        for r in dataframe_to_rows(sdf, index=False, header=True):
-            ws.append(r)
-        wb.save(output_file)
-        output_files.append(output_file)
-    
-    return output_files
+            if period not in rows_dict:
+                # Make sure we have a list (initially just the header) to hold rows for each period
+                rows_dict[period] = [["STUDENT_PERM_ID", "STUDENT_FIRST_NAME", "STUDENT_LAST_NAME", "ASSIGNMENT_NAME", "ASSIGNMENT_DESCRIPTION",
+                                      "OVERALL_SCORE", "POINTS", "ASSIGNMENT_TYPE", "ASSIGNMENT_DATE"]]
+            rows_dict[period].append(output_row)
+            row_count += 1
+
+    # Files are written under temporary names and only renamed to their real names once every file has been written, so a
+    # failed or interrupted run never leaves half-written (or a partial set of) bulk import files behind
+    use_pool = writer_pool is not None or row_count >= writer_pool_min_rows     # (get_writer_pool replaces a broken pool)
+    writes = OrderedDict()      # period -> (output file, temporary file, future for the write if it's on the writer pool)
+    try:
+        for period, rows in rows_dict.items():
+            output_file = output_dir + os.path.sep + "Synergy bulk import for P" + str(period) + " " + course + ".xlsx"
+            temp_file = get_temp_file_name (output_file)
+            writes[period] = (output_file, temp_file, None)
+            if use_pool:
+                writes[period] = (output_file, temp_file, get_writer_pool().submit(write_synergy_file, rows, temp_file))
+            else:
+                write_synergy_file (rows, temp_file)
+
+        for period, (output_file, temp_file, future) in writes.items():
+            if future is not None:
+                try:
+                    future.result()     # Wait for the write (and raise any error it hit)
+                except BrokenProcessPool:
+                    println ("A Synergy file writer process died - writing " + os.path.basename(output_file) + " here instead")
+                    write_synergy_file (rows_dict[period], temp_file)
+
+        output_files = []
+        for output_file, temp_file, future in writes.values():
+            os.replace(temp_file, output_file)
+            output_files.append(output_file)
+        return output_files
+    finally:
+        # Don't start writes nobody will use, and let any in progress finish before removing their temporary files
+        futures = [future for output_file, temp_file, future in writes.values() if future is not None]
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        for output_file, temp_file, future in writes.values():
+            if os.path.exists(temp_file):
+                os.remove(temp_file)